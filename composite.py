@@ -1,4 +1,29 @@
+import threading
+import weakref
+from contextlib import nullcontext
+
+import cv2
+import numpy as np
+from loguru import logger
+from numba import njit, prange
+from wand.color import Color
 from wand.image import Image
+from wand.version import QUANTUM_RANGE
+
+try:
+    import cupy as cp
+
+    # 能导入 CuPy 不代表有可用的 GPU（没有设备或驱动版本不匹配时同样可以导入）
+    if not cp.cuda.is_available():
+        cp = None
+except ImportError:
+    cp = None
+
+# numba 默认的 workqueue 线程层不支持多个线程同时调用并行内核
+_kernel_lock = threading.Lock()
+
+# 遮罩 alpha 缓存，键为 (id(遮罩), 宽, 高)，遮罩对象释放时自动移除
+_mask_alpha_cache = {}
 
 
 def create_tiled_texture(texture, target_width, target_height, scale_factor=1.0):
@@ -15,103 +40,169 @@ def create_tiled_texture(texture, target_width, target_height, scale_factor=1.0)
     texture_width = int(texture.width * scale_factor)
     texture_height = int(texture.height * scale_factor)
 
-    # 先缩放纹理
-    with texture.clone() as scaled_texture:
-        scaled_texture.resize(texture_width, texture_height)
+    # 先缩放纹理，尺寸不变时直接使用原纹理，不需要复制
+    same_size = texture.size == (texture_width, texture_height)
+    with nullcontext(texture) if same_size else texture.clone() as scaled_texture:
+        if not same_size:
+            scaled_texture.resize(texture_width, texture_height)
 
-        with Image(width=target_width, height=target_height) as tiled:
-            # 计算需要重复的次数
-            cols = (target_width + texture_width - 1) // texture_width
-            rows = (target_height + texture_height - 1) // texture_height
+        # 一次性将纹理平铺到目标尺寸的画布上，无需逐块合成和裁剪
+        tiled = Image(width=target_width, height=target_height)
+        tiled.texture(scaled_texture)
+        return tiled
 
-            # 平铺纹理
-            for y in range(rows):
-                for x in range(cols):
-                    tiled.composite(
-                        scaled_texture, left=x * texture_width, top=y * texture_height
-                    )
 
-            # 裁剪到目标尺寸
-            tiled.crop(width=target_width, height=target_height)
-            return tiled.clone()
+def create_tiled_texture_array(
+    texture: np.ndarray, target_width, target_height, scale_factor=1.0
+):
+    """
+    创建平铺纹理数组，用 np.tile 一次性完成整块复制
 
+    参数:
+        texture: np.ndarray, 纹理图像
+        target_width: int, 目标宽度
+        target_height: int, 目标高度
+        scale_factor: float, 纹理缩放系数 (>0)
+    """
+    # 计算缩放后的纹理尺寸
+    texture_width = max(int(texture.shape[1] * scale_factor), 1)
+    texture_height = max(int(texture.shape[0] * scale_factor), 1)
+
+    # 先缩放纹理
+    interpolation = cv2.INTER_AREA if scale_factor < 1 else cv2.INTER_LINEAR
+    scaled_texture = cv2.resize(
+        texture, (texture_width, texture_height), interpolation=interpolation
+    )
 
-def composite_images(texture_path, background_path, mask_path, tile=False):
+    # 计算需要重复的次数，平铺后裁剪到目标尺寸
+    rows = -(-target_height // texture_height)
+    cols = -(-target_width // texture_width)
+    reps = (rows, cols) + (1,) * (scaled_texture.ndim - 2)
+    tiled = np.tile(scaled_texture, reps)[:target_height, :target_width]
+    return np.ascontiguousarray(tiled)
+
+
+def composite_images(texture: Image, background: Image, mask: Image, tile=False):
     """
     将纹理图和背景图按照mask进行合成
 
     参数:
-        texture_path: str, 纹理图路径
-        background_path: str, 背景图路径
-        mask_path: str, 遮罩图路径（黑白图片）
+        texture: Image, 纹理图
+        background: Image, 背景图
+        mask: Image, 遮罩图（黑白图片）
         tile: bool, 是否平铺纹理
 
     返回:
         Image对象，合成后的图片
     """
-    with Image(filename=texture_path) as texture:
-        with Image(filename=background_path) as background:
-            with Image(filename=mask_path) as mask:
-                # 调整mask尺寸以匹配背景图
-                mask.resize(background.width, background.height)
-
-                # 如果需要平铺纹理
-                if tile:
-                    texture = create_tiled_texture(
-                        texture, background.width, background.height
-                    )
-
-                # 简单的遮罩合成
-                with background.clone() as result:
-                    # 应用遮罩到纹理
-                    texture.composite(mask, operator="copy_opacity")
-                    # 合成到背景
-                    result.composite(texture, operator="multiply")
-                    final = result.clone()
+    # 调整mask尺寸以匹配背景图，尺寸一致时直接使用原遮罩
+    same_size = mask.size == background.size
+    with nullcontext(mask) if same_size else mask.clone() as alpha:
+        if not same_size:
+            alpha.resize(background.width, background.height)
+
+        # 如果需要平铺纹理
+        if tile:
+            masked_texture = create_tiled_texture(
+                texture, background.width, background.height
+            )
+        else:
+            masked_texture = texture.clone()
+
+        # 简单的遮罩合成
+        with masked_texture:
+            # 应用遮罩到纹理
+            masked_texture.composite(alpha, operator="copy_opacity")
+            # 合成到背景
+            result = background.clone()
+            result.composite(masked_texture, operator="multiply")
 
-    return final
+    return result
 
 
 def generate_lighting_map(
-    depth_map: Image,
-    background: Image,
-    mask: Image,
+    depth_map: Image | np.ndarray,
+    background: Image | np.ndarray,
+    mask: Image | np.ndarray = None,
     lighting_strength=0.5,
     light_color="grey48",
+    background_gray: np.ndarray | None = None,
 ):
     """
     基于背景图和深度图生成光照图
 
+    全部在 8 位数组上用 OpenCV 的饱和运算完成
+
     参数:
-        depth_map: Wand.Image 对象，深度图
-        background: Wand.Image 对象，背景图
-        mask: Wand.Image 对象，遮罩图
+        depth_map: Wand.Image 对象或数组，深度图
+        background: Wand.Image 对象或数组，背景图
+        mask: Wand.Image 对象或数组，遮罩图；composite_with_lighting 会统一按遮罩混合，
+              传给它的光照图可以不带遮罩
         lighting_strength: float, 光照强度 (0-1)
         light_color: str, 光照颜色
+        background_gray: uint8[H, W] 数组，预先计算好的背景灰度图，传入时不再重复转换
+
+    返回:
+        uint8[H, W, 3] 的光照图，传入 mask 时为 uint8[H, W, 4]
     """
-    with depth_map.clone() as lighting_map:
-        # 从景图提取亮度信息
-        with background.clone() as bg_lighting:
-            bg_lighting.transform_colorspace("gray")
-            bg_lighting.normalize()
+    width, height = _image_size(background)
+
+    # 从景图提取亮度信息，与深度图相乘
+    if background_gray is None:
+        background_gray = background
+    bg_lighting = _gray_array(background_gray, width, height, normalize=True)
+    depth = _gray_array(depth_map, width, height)
+    lighting_map = cv2.multiply(bg_lighting, depth, scale=1 / 255)
+
+    # 调整光照强度；与 Wand 的 evaluate 一致，数值按 quantum 单位计算
+    offset = round(lighting_strength * 255 / QUANTUM_RANGE)
+    if offset > 0:
+        lighting_map = cv2.subtract(lighting_map, offset)
+
+    # 光照颜色与光照图相乘，得到最终的光照层
+    color = Color(light_color)
+    light_layer = np.empty((height, width, 4 if mask is not None else 3), np.uint8)
+    for channel, value in enumerate(
+        (color.red_int8, color.green_int8, color.blue_int8)
+    ):
+        light_layer[:, :, channel] = cv2.convertScaleAbs(
+            lighting_map, alpha=value / 255
+        )
+
+    # 应用遮罩
+    if mask is not None:
+        light_layer[:, :, 3] = _mask_alpha(mask, width, height)
 
-            # 结合深度图和背景亮度
-            lighting_map.composite(bg_lighting, operator="multiply")
+    return light_layer
 
-        # 调整光照强度
-        lighting_map.evaluate("subtract", lighting_strength)
-        lighting_map.background_color = "grey50"
-        lighting_map.alpha_channel = "remove"
 
-        # 创建最终的光照层
-        with Image(
-            width=background.width, height=background.height, background=light_color
-        ) as light_layer:
-            light_layer.composite(lighting_map, operator="multiply")
-            # 应用遮罩
-            light_layer.composite(mask, operator="copy_opacity")
+def _tone_curve(black_point=0, white_point=100, gamma=1.0, contrast=1.0, lightness=0):
+    """
+    将色阶、伽马、对比度和明度组合为一条 256 级的色调曲线
 
-            return light_layer.clone()
+    8 位图像每个通道只有 256 种取值，预先计算后逐像素只需查表
+
+    返回:
+        float32[256], 取值 0-1
+    """
+    x = np.arange(256, dtype=np.float64) / 255
+
+    # 1. 色阶和伽马
+    black, white = black_point / 100, white_point / 100
+    x = np.clip((x - black) / max(white - black, 1e-6), 0, 1) ** (1 / gamma)
+
+    # 2. S 曲线对比度，两端缩放回 [0, 1]
+    if contrast != 1.0:
+        strength = contrast * 3
+        low = 1 / (1 + np.exp(0.5 * strength))
+        high = 1 / (1 + np.exp(-0.5 * strength))
+        x = (1 / (1 + np.exp(strength * (0.5 - x))) - low) / (high - low)
+
+    # 3. 明度，100 是原始明度
+    if lightness != 0:
+        x = np.clip(x * (1 + lightness / 100), 0, 1)
+
+    return x.astype(np.float32)
 
 
 def adjust_levels(
@@ -120,6 +211,12 @@ def adjust_levels(
     """
     调整图像的色阶、伽马、对比度和明度
 
+    三个步骤合成一张查找表，用一次 cv2.LUT 完成；明度按通道等比缩放，
+    对灰度图与 modulate 结果一致
+
+    独立的 Wand 辅助函数，不在组合效果流程中使用；
+    流程中的色调调整由 _tone_curve 和 _fuse_lighting 完成
+
     参数:
         image: Image, 输入图像
         black_point: float, 黑场值 (0-100)
@@ -130,27 +227,16 @@ def adjust_levels(
                < 0 降低明度
                > 0 提高明度
     """
-    with image.clone() as adjusted:
-        # 1. 首先应用色阶调整（包括伽马）
-        adjusted.level(
-            black=black_point / 100, white=white_point / 100, gamma=gamma, channel="all"
-        )
-
-        # 2. 调整对比度
-        if contrast != 1.0:
-            adjusted.sigmoidal_contrast(
-                sharpen=True,
-                strength=contrast * 3,
-                midpoint=0.5 * adjusted.quantum_range,
-            )
+    curve = _tone_curve(black_point, white_point, gamma, contrast, lightness)
+    lut = (curve * 255 + 0.5).astype(np.uint8)
 
-        # 3. 调整明度
-        if lightness != 0:
-            # 使用 modulate 调整明度
-            # 100 是原始明度，大于100增加明度，小于100降低明度
-            adjusted.modulate(brightness=100 + lightness)
-
-        return adjusted.clone()
+    channel_map = "I" if image.colorspace == "gray" else "RGB"
+    arr = np.array(image)
+    colors = np.ascontiguousarray(arr[:, :, : len(channel_map)])
+    arr[:, :, : len(channel_map)] = cv2.LUT(colors, lut).reshape(colors.shape)
+    if image.alpha_channel:
+        channel_map += "A"
+    return Image.from_array(arr, channel_map=channel_map)
 
 
 def tint_masked_area(
@@ -169,76 +255,327 @@ def tint_masked_area(
     2. 标准化处理，使亮度分布更均匀
     3. 应用色阶和对比度调整
     4. 平滑边缘过渡
+
+    独立的 Wand 辅助函数，不在组合效果流程中使用；
+    composite_with_lighting 在 _fuse_lighting 中完成同样的步骤，结果不保证逐像素一致
     """
-    with background.clone() as result:
-        with background.clone() as bw_bg:
-            # 转换为灰度（黑白）
-            bw_bg.transform_colorspace("gray")
-
-            # 添加标准化处理，使亮度分布更均匀
-            bw_bg.normalize()
-
-            # 调整色阶、对比度和明度
-            bw_bg = adjust_levels(
-                bw_bg,
-                black_point=black_point,
-                white_point=white_point,
-                gamma=gamma,
-                contrast=contrast,
-                lightness=lightness,
-            )
+    with background.clone() as gray:
+        # 转换为灰度（黑白）
+        gray.transform_colorspace("gray")
+
+        # 添加标准化处理，使亮度分布更均匀
+        gray.normalize()
+
+        # 调整色阶、对比度和明度（返回新图像）
+        bw_bg = adjust_levels(
+            gray,
+            black_point=black_point,
+            white_point=white_point,
+            gamma=gamma,
+            contrast=contrast,
+            lightness=lightness,
+        )
 
-            # 添加轻微的高斯模糊，平滑边缘
-            bw_bg.gaussian_blur(sigma=0.5)
+    with bw_bg:
+        # 添加轻微的高斯模糊，平滑边缘
+        bw_bg.gaussian_blur(sigma=0.5)
+
+        # 使用遮罩将黑白区域合成到原图
+        bw_bg.composite(mask, operator="copy_opacity")
+        result = background.clone()
+        result.composite(bw_bg, operator="over")
+
+    return result
+
+
+# 带显式签名的内核在导入时即完成编译（cache=True 时直接读取磁盘缓存），
+# 第一次点击不再等待 JIT 编译
+@njit(
+    "void(uint8[:, ::1], uint8[:, ::1], uint8[:, ::1], uint8[:, :, ::1])",
+    parallel=True,
+    fastmath=True,
+    cache=True,
+)
+def _high_pass(gray, blurred, mask, out):
+    """以 128 为灰色底色写入 gray - blurred，并将遮罩写入 alpha"""
+    height, width = gray.shape
+    for y in prange(height):
+        for x in range(width):
+            value = 128 + np.int16(gray[y, x]) - np.int16(blurred[y, x])
+            value = np.uint8(min(max(value, 0), 255))
+            out[y, x, 0] = value
+            out[y, x, 1] = value
+            out[y, x, 2] = value
+            out[y, x, 3] = mask[y, x]
+
+
+def _high_freq_numba(gray: np.ndarray, sigma: float, mask: np.ndarray) -> np.ndarray:
+    """
+    计算灰度图的高频细节
 
-            # 使用遮罩将黑白区域合成到原图
-            bw_bg.composite(mask, operator="copy_opacity")
-            result.composite(bw_bg, operator="over")
+    参数:
+        gray: uint8[H, W], 灰度图
+        sigma: float, 高斯模糊的标准差
+        mask: uint8[H, W], 遮罩，作为输出的 alpha
 
-        return result.clone()
+    返回:
+        uint8[H, W, 4] 的 RGBA 数组
+    """
+    blurred = cv2.GaussianBlur(gray, (0, 0), sigmaX=sigma)
+    out = np.empty(gray.shape + (4,), dtype=np.uint8)
+    with _kernel_lock:
+        _high_pass(gray, blurred, mask, out)
+    return out
 
 
 def extract_high_frequency(image: Image, mask: Image, blur_radius=0.5):
     """
     提取图像的高频细节，保持灰色底色
 
+    独立的 Wand 辅助函数，不在组合效果流程中使用；
+    composite_with_lighting 直接调用 _high_freq_numba，只取灰度细节
+
     参数:
         image: Image, 输入图像
         mask: Image, 遮罩图像
         blur_radius: float, 高斯模糊半径
     """
-    with image.clone() as high_freq:
-        # 先转换为灰度
-        high_freq.transform_colorspace("gray")
+    width, height = image.width, image.height
+    high_freq = _high_freq_numba(
+        _gray_array(image, width, height),
+        blur_radius,
+        _gray_array(mask, width, height),
+    )
+    return Image.from_array(high_freq)
 
-        # 创建模糊版本
-        with high_freq.clone() as blurred:
-            blurred.gaussian_blur(sigma=blur_radius)
 
-            # 取高频细节 (原图 - 模糊图)
-            high_freq.composite(blurred, operator="difference")
+def _rgb_array(image, width, height, fill=255):
+    """
+    将 Wand 图像或数组转为 (height, width, 3) 的 uint8 数组，尺寸不足的区域用 fill 填充
+    """
+    arr = np.asarray(image)
+    if arr.ndim == 2:
+        arr = arr[:, :, None]
+    if arr.shape[2] < 3:
+        arr = np.repeat(arr[:, :, :1], 3, axis=2)
+    arr = arr[:height, :width, :3]
+    if arr.shape[:2] != (height, width):
+        canvas = np.full((height, width, 3), fill, dtype=np.uint8)
+        canvas[: arr.shape[0], : arr.shape[1]] = arr
+        arr = canvas
+    return np.ascontiguousarray(arr)
+
+
+def _image_size(image):
+    """返回 (width, height)，兼容 Wand 图像和数组"""
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.width, image.height
+
+
+def _mask_alpha(mask, width, height):
+    """
+    取遮罩的 uint8 alpha，同一个遮罩对象只计算一次
 
-            # 调整对比度使细节更明显
-            high_freq.normalize()
+    后续各步骤直接使用这份 alpha 混合，不再逐步执行 copy_opacity
+    """
+    key = (id(mask), width, height)
+    alpha = _mask_alpha_cache.get(key)
+    if alpha is None:
+        alpha = _gray_array(mask, width, height)
+        _mask_alpha_cache[key] = alpha
+        weakref.finalize(mask, _mask_alpha_cache.pop, key, None)
+    return alpha
+
+
+def _normalize(gray: np.ndarray) -> np.ndarray:
+    """与 ImageMagick normalize 相同的对比度拉伸：最暗 2% 和最亮 1% 的像素被裁掉"""
+    cdf = np.cumsum(np.bincount(gray.ravel(), minlength=256))
+    low = np.searchsorted(cdf, 0.02 * gray.size)
+    high = np.searchsorted(cdf, 0.99 * gray.size)
+    if high <= low:
+        return gray
+    levels = (np.arange(256, dtype=np.float32) - low) * 255 / (high - low)
+    lut = np.clip(levels + 0.5, 0, 255).astype(np.uint8)
+    return cv2.LUT(gray, lut)
+
+
+def _gray_array(image, width, height, normalize=False, blur_sigma=0.0):
+    """
+    将 Wand 图像或数组转为 (height, width) 的 uint8 灰度数组
 
-            # 创建灰色背景
-            with Image(
-                width=image.width, height=image.height, background="gray50"
-            ) as gray_bg:
-                # 将高频细节叠加到灰色背景上
-                gray_bg.composite(high_freq, operator="overlay")
+    全程在 8 位数据上用 OpenCV 处理，不经过 ImageMagick 的 16 位 quantum
+    """
+    arr = np.asarray(image)
+    if arr.ndim == 3 and arr.shape[2] >= 3:
+        gray = cv2.cvtColor(np.ascontiguousarray(arr[:, :, :3]), cv2.COLOR_RGB2GRAY)
+    elif arr.ndim == 3:
+        gray = np.ascontiguousarray(arr[:, :, 0])
+    else:
+        gray = arr
+    if gray.shape != (height, width):
+        gray = cv2.resize(gray, (width, height), interpolation=cv2.INTER_LINEAR)
+    if normalize:
+        gray = _normalize(gray)
+    if blur_sigma > 0:
+        gray = cv2.GaussianBlur(gray, (0, 0), sigmaX=blur_sigma)
+    return np.ascontiguousarray(gray)
+
+
+@njit(inline="always")
+def _blend_overlay(src, dst):
+    if dst < 0.5:
+        return 2.0 * src * dst
+    return 1.0 - 2.0 * (1.0 - src) * (1.0 - dst)
+
+
+# 与 _high_pass 相同，按显式签名在导入时编译
+@njit(
+    "void(uint8[:, :, ::1], uint8[:, ::1], uint8[:, ::1], uint8[:, :, ::1], "
+    "uint8[:, :, ::1], uint8[:, ::1], float32[::1], float64, float64, "
+    "uint8[:, :, ::1])",
+    parallel=True,
+    fastmath=True,
+    cache=True,
+)
+def _fuse_lighting(
+    background,
+    gray,
+    mask,
+    texture,
+    lighting,
+    details,
+    tone,
+    lighting_strength,
+    detail_strength,
+    out,
+):
+    """
+    逐像素完成色调曲线、遮罩混合、强光、正片叠底和叠加，每个像素只读写一次
 
-                # 最后应用遮罩
-                gray_bg.composite(mask, operator="copy_opacity")
+    参数:
+        background: uint8[H, W, 3], 背景图
+        gray: uint8[H, W], 归一化后的背景灰度
+        mask: uint8[H, W], 遮罩
+        texture: uint8[H, W, 3], 纹理图
+        lighting: uint8[H, W, 3], 光照图，按遮罩混合；lighting_strength 为 0 时不读取
+        details: uint8[H, W], 高频细节
+        tone: float32[256], 色调曲线，见 _tone_curve
+        out: uint8[H, W, 3], 输出
+    """
+    height, width = gray.shape
+    lighting_offset = 1.0 - lighting_strength
+
+    for y in prange(height):
+        for x in range(width):
+            # 1. 灰度查表完成色阶、伽马、对比度和明度
+            g = tone[gray[y, x]]
+
+            m = mask[y, x] / 255.0
+            la = max(m - lighting_offset, 0.0)
+            d = details[y, x] / 255.0 * detail_strength
+            dm = m * detail_strength
+
+            for c in range(3):
+                # 2. 遮罩区域替换为调整后的灰度
+                bg = background[y, x, c] / 255.0
+                r = bg + m * (g - bg)
+
+                # 3. 强光叠加光照图 (hard light 以光照为判断条件)
+                if lighting_strength > 0:
+                    light = lighting[y, x, c] / 255.0
+                    r = r + la * (_blend_overlay(r, light) - r)
+
+                # 4. 正片叠底纹理
+                r = r + m * (texture[y, x, c] / 255.0 * r - r)
+
+                # 5. 叠加高频细节
+                if detail_strength > 0:
+                    r = r + dm * (_blend_overlay(d, r) - r)
+
+                out[y, x, c] = np.uint8(min(max(r, 0.0), 1.0) * 255.0 + 0.5)
+
+
+if cp is not None:
+    # 与 _fuse_lighting 相同的逐像素融合，一次 kernel 启动完成，整图只读写一次显存
+    _fuse_lighting_cu = cp.ElementwiseKernel(
+        "uint8 bg, uint8 gray, uint8 mask, uint8 tex, uint8 light, uint8 detail, "
+        "raw float32 tone, float32 lighting_offset, "
+        "float32 detail_strength",
+        "uint8 out",
+        """
+        float g = tone[gray];
+        float m = mask / 255.0f;
+        float la = fmaxf(m - lighting_offset, 0.0f);
+
+        float r = bg / 255.0f;
+        r = r + m * (g - r);
+
+        if (lighting_offset < 1.0f) {
+            float l = light / 255.0f;
+            float hl = l < 0.5f ? 2.0f * r * l : 1.0f - 2.0f * (1.0f - r) * (1.0f - l);
+            r = r + la * (hl - r);
+        }
+
+        r = r + m * (tex / 255.0f * r - r);
+
+        if (detail_strength > 0.0f) {
+            float d = detail / 255.0f * detail_strength;
+            float ov = r < 0.5f ? 2.0f * d * r : 1.0f - 2.0f * (1.0f - d) * (1.0f - r);
+            r = r + m * detail_strength * (ov - r);
+        }
+
+        out = (unsigned char)(fminf(fmaxf(r, 0.0f), 1.0f) * 255.0f + 0.5f);
+        """,
+        "composite_fuse",
+    )
 
-                return gray_bg.clone()
+
+def composite_with_lighting_cu(
+    background_cu,
+    gray_cu,
+    mask_cu,
+    texture_cu,
+    lighting_cu,
+    details_cu,
+    tone,
+    lighting_strength=0.5,
+    detail_strength=0.5,
+):
+    """
+    在 GPU 上完成与 _fuse_lighting 相同的融合
+
+    参数:
+        background_cu: cupy uint8[H, W, 3], 背景图
+        gray_cu: cupy uint8[H, W], 归一化后的背景灰度
+        mask_cu: cupy uint8[H, W], 遮罩
+        texture_cu: cupy uint8[H, W, 3], 纹理图
+        lighting_cu: cupy uint8[H, W, 3], 光照图，按遮罩混合；
+                     lighting_strength 为 0 时可传入广播用的 [1, 1, 3] 占位
+        details_cu: cupy uint8[H, W], 高频细节
+        tone: float32[256], 色调曲线，见 _tone_curve
+
+    返回:
+        cupy uint8[H, W, 3]
+    """
+    return _fuse_lighting_cu(
+        background_cu,
+        gray_cu[:, :, None],
+        mask_cu[:, :, None],
+        texture_cu,
+        lighting_cu,
+        details_cu[:, :, None],
+        cp.asarray(tone),
+        np.float32(1 - lighting_strength),
+        np.float32(detail_strength),
+    )
 
 
 def composite_with_lighting(
-    texture: Image,
-    background: Image,
-    mask: Image,
-    lighting_map: Image,
+    texture: Image | np.ndarray,
+    background: Image | np.ndarray,
+    mask: Image | np.ndarray,
+    lighting_map: Image | np.ndarray | None,
     lighting_strength=0.5,
     black_point=0,
     white_point=100,
@@ -246,43 +583,66 @@ def composite_with_lighting(
     contrast=1.0,
     lightness=0,
     detail_strength=0.5,
+    background_gray: np.ndarray | None = None,
 ):
     """
     将纹理图、光照图和背景图进行合成，并保留原图细节
-    """
-    # 提取背景图的高频细节（包含遮罩）
-    high_freq = extract_high_frequency(background, mask)
-
-    # 进行正常的合成处理
-    background = tint_masked_area(
-        background,
-        mask,
-        black_point=black_point,
-        white_point=white_point,
-        gamma=gamma,
-        contrast=contrast,
-        lightness=lightness,
-    )
 
-    # 应用遮罩到纹理
-    with texture.clone() as masked_texture:
-        masked_texture.composite(mask, operator="copy_opacity")
+    所有逐像素的混合都在 _fuse_lighting 中一次完成，避免多次整图读写；
+    传入 background_gray 时，细节提取和色阶调整直接复用这份灰度图
 
-        # 在背景上应用光照和纹理
-        with background.clone() as result:
-            with lighting_map.clone() as adjusted_lighting:
-                adjusted_lighting.transparentize(1 - lighting_strength)
-                result.composite(adjusted_lighting, operator="hard_light")
+    返回:
+        uint8[H, W, 3] 的合成结果，不再转换回 Wand 图像
+    """
+    width, height = _image_size(background)
+    if background_gray is None:
+        background_gray = background
 
-            # 合成纹理
-            result.composite(masked_texture, operator="multiply")
+    background_arr = _rgb_array(background, width, height)
+    mask_arr = _mask_alpha(mask, width, height)
 
-            # 叠加高频细节
-            if detail_strength > 0:
-                with high_freq.clone() as details:
-                    # 调整细节强度
-                    details.evaluate("multiply", detail_strength)
-                    # 叠加细节（已经包含遮罩，不需要再次应用）
-                    result.composite(details, operator="overlay")
+    # 提取背景图的高频细节，只取灰度值，遮罩在融合内核中处理
+    details = _high_freq_numba(
+        _gray_array(background_gray, width, height), 0.5, mask_arr
+    )
+    details = np.ascontiguousarray(details[:, :, 0])
+
+    # 灰度化的平滑处理放在色阶之前，便于后续逐像素融合
+    gray = _gray_array(background_gray, width, height, normalize=True, blur_sigma=0.5)
+    # 纹理未覆盖的区域填充白色，正片叠底后保持不变
+    texture_arr = _rgb_array(texture, width, height, fill=255)
+    if lighting_map is None or lighting_strength <= 0:
+        # 没有光照图或光照强度为 0 时，融合内核整体跳过强光步骤，
+        # 光照图只作占位，不分配整图大小的数组
+        lighting_strength = 0.0
+        lighting_arr = np.zeros((1, 1, 3), np.uint8)
+    else:
+        lighting_arr = _rgb_array(lighting_map, width, height, fill=128)
+
+    tone = _tone_curve(black_point, white_point, gamma, contrast, lightness)
+    arrays = (
+        background_arr,
+        gray,
+        mask_arr,
+        texture_arr,
+        lighting_arr,
+        details,
+    )
 
-            return result.clone()
+    # 有可用的 GPU 时在 GPU 上融合，否则使用 CPU 上的 Numba 内核
+    if cp is not None:
+        try:
+            return composite_with_lighting_cu(
+                *(cp.asarray(arr) for arr in arrays),
+                tone,
+                lighting_strength=lighting_strength,
+                detail_strength=detail_strength,
+            ).get()
+        except Exception as e:
+            # 显存不足、NVRTC 编译失败或驱动错误时退回到 CPU，不让整次合成失败
+            logger.warning(f"GPU 融合失败，改用 CPU: {e}")
+
+    out = np.empty_like(background_arr)
+    with _kernel_lock:
+        _fuse_lighting(*arrays, tone, lighting_strength, detail_strength, out)
+    return out
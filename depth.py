@@ -1,18 +1,75 @@
+import threading
+
 import numpy as np
+import torch
+import torch.nn.functional as F
 from loguru import logger
 from PIL import Image
-from transformers import pipeline
+from transformers import AutoImageProcessor, AutoModelForDepthEstimation
+
+MODEL_NAME = "depth-anything/Depth-Anything-V2-Small-hf"
 
-# load pipe
-pipe = pipeline(
-    task="depth-estimation",
-    model="depth-anything/Depth-Anything-V2-Small-hf",
-    device="cuda",
+# load model (FP16, 常驻 GPU)
+processor = AutoImageProcessor.from_pretrained(MODEL_NAME)
+model = (
+    AutoModelForDepthEstimation.from_pretrained(MODEL_NAME).to("cuda").half().eval()
 )
 
+# 复用的锁页内存缓冲区，用于异步拷贝到 GPU
+_staging = None
+_staging_lock = threading.Lock()
+
+
+def _to_cuda(pixel_values: torch.Tensor) -> torch.Tensor:
+    """通过锁页内存缓冲区将输入异步拷贝到 GPU"""
+    global _staging
+    numel = pixel_values.numel()
+    if _staging is None or _staging.numel() < numel:
+        _staging = torch.empty(numel, dtype=torch.float16, pin_memory=True)
+    staging = _staging[:numel].view(pixel_values.shape)
+    staging.copy_(pixel_values)
+    return staging.to("cuda", non_blocking=True)
+
+
+def handle_depth_batch(images: list[np.ndarray]) -> list[Image.Image]:
+    """
+    批量生成深度图
+
+    预处理后尺寸相同的图片合并为一个批次推理，推理结果在 GPU 上插值回原图尺寸
+    """
+    logger.info(f"批量处理深度图: {len(images)} 张")
+    pil_images = [Image.fromarray(image) for image in images]
+
+    # 按预处理后的尺寸分组，同尺寸的图片才能堆叠成一个批次
+    groups = {}
+    for index, image in enumerate(pil_images):
+        pixel_values = processor(images=image, return_tensors="pt")["pixel_values"]
+        groups.setdefault(tuple(pixel_values.shape[1:]), []).append(
+            (index, pixel_values)
+        )
+
+    depths = [None] * len(pil_images)
+    with _staging_lock, torch.inference_mode():
+        for group in groups.values():
+            indices = [index for index, _ in group]
+            batch = torch.cat([pixel_values for _, pixel_values in group])
+            with torch.autocast("cuda", dtype=torch.float16):
+                predicted_depth = model(pixel_values=_to_cuda(batch)).predicted_depth
+
+            for index, depth in zip(indices, predicted_depth):
+                width, height = pil_images[index].size
+                depth = F.interpolate(
+                    depth[None, None].float(),
+                    size=(height, width),
+                    mode="bicubic",
+                    align_corners=False,
+                )[0, 0]
+                depth = (depth * 255 / depth.max()).clamp(0, 255)
+                depths[index] = Image.fromarray(depth.to(torch.uint8).cpu().numpy())
+
+    return depths
+
 
 def handle_depth(image: np.ndarray) -> Image.Image:
     logger.info("处理深度图")
-    image = Image.fromarray(image)
-    depth = pipe(image)["depth"]
-    return depth
+    return handle_depth_batch([image])[0]
@@ -1,7 +1,74 @@
+from contextlib import nullcontext
 from wand.image import Image
 from wand.display import display
+import cv2
 import numpy as np
 
+def displacement_mapping_cv(original, depth, strength=1.0):
+    """
+    使用 OpenCV remap 对图片数组进行凹凸置换
+    
+    与 ImageMagick 的 displace 约定一致：50% 灰不偏移，白色偏移 +strength，
+    黑色偏移 -strength；单通道深度图同时控制 x、y 方向，
+    多通道时红色通道控制 x、绿色通道控制 y
+    
+    参数:
+        original: np.ndarray, 原始图片
+        depth: np.ndarray, 深度图
+        strength: float, 置换强度，默认为1.0
+    
+    返回:
+        np.ndarray，处理后的图片
+    """
+    
+    # 强度为 0 时置换不产生任何偏移，直接返回原图
+    if strength == 0:
+        return original
+    
+    height, width = original.shape[:2]
+    # 确保深度图和原图尺寸一致
+    if depth.shape[:2] != (height, width):
+        depth = cv2.resize(depth, (width, height), interpolation=cv2.INTER_LINEAR)
+    
+    depth = depth.astype(np.float32)
+    if depth.ndim == 2:
+        offset_x = offset_y = (depth - 128) * (strength / 128)
+    else:
+        offset_x = (depth[:, :, 0] - 128) * (strength / 128)
+        offset_y = (depth[:, :, 1] - 128) * (strength / 128)
+    
+    map_x = offset_x + np.arange(width, dtype=np.float32)[None, :]
+    map_y = offset_y + np.arange(height, dtype=np.float32)[:, None]
+    # 边缘像素延伸，与 ImageMagick 默认的 edge 虚拟像素一致
+    return cv2.remap(original, map_x, map_y, cv2.INTER_LINEAR,
+                     borderMode=cv2.BORDER_REPLICATE)
+
+def displacement_mapping_img(original, depth, strength=1.0):
+    """
+    对内存中的图片进行凹凸置换，不经过文件读写
+    
+    参数:
+        original: Image, 原始图片
+        depth: Image, 深度图
+        strength: float, 置换强度，默认为1.0
+    
+    返回:
+        Image对象，处理后的图片
+    """
+    
+    # 确保深度图和原图尺寸一致，尺寸相同时直接使用原深度图
+    same_size = depth.size == original.size
+    with nullcontext(depth) if same_size else depth.clone() as depth_map:
+        if not same_size:
+            depth_map.resize(original.width, original.height)
+        
+        # 使用 composite 方法和 displace 操作符进行位移
+        result = original.clone()
+        result.composite(depth_map, operator='displace', 
+                         arguments=f'{strength},{strength}')
+    
+    return result
+
 def displacement_mapping(original_path, depth_path, strength=1.0):
     """
     对图片进行凹凸置换
@@ -17,19 +84,7 @@ def displacement_mapping(original_path, depth_path, strength=1.0):
     
     with Image(filename=original_path) as original:
         with Image(filename=depth_path) as depth:
-            # 确保深度图和原图尺寸一致
-            depth.resize(original.width, original.height)
-            
-            # 创建位移图像
-            with original.clone() as displaced:
-                # 使用 composite 方法和 displace 操作符进行位移
-                displaced.composite(depth, operator='displace', 
-                                    arguments=f'{strength},{strength}')
-                
-                # 克隆结果
-                result = displaced.clone()
-    
-    return result
+            return displacement_mapping_img(original, depth, strength)
 
 # 使用示例
 if __name__ == "__main__":
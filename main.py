@@ -1,54 +1,187 @@
+import functools
+import math
 import os
-import tempfile
-import uuid
+import threading
 import traceback
-import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import xxhash
 from pathlib import Path
 
+import cv2
 import gradio as gr
 from loguru import logger
-from PIL import Image, ImageFilter
+from PIL import Image
+from scipy.signal import fftconvolve
+from wand.color import Color
 from wand.image import Image as WandImage
 
 from composite import (
     composite_images,
-    create_tiled_texture,
+    create_tiled_texture_array,
     generate_lighting_map,
     composite_with_lighting,
 )
 from depth import handle_depth
-from displacement import displacement_mapping
+from displacement import displacement_mapping_cv
 
 # 添加缓存目录配置
 CACHE_DIR = Path("cache/depth_maps")
 CACHE_DIR.mkdir(parents=True, exist_ok=True)
+BLURRED_CACHE_DIR = Path("cache/depth_maps_blurred")
+BLURRED_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+# 超过该模糊半径时改用 FFT 卷积
+FFT_BLUR_RADIUS = 12
+
+# 缓存的深度图只供程序自己读取，使用最低的 zlib 压缩等级以加快写入
+CACHE_PNG_OPTIONS = {"compress_level": 1}
+
+# A、B 两组结果共用的线程池
+_pool = ThreadPoolExecutor(max_workers=2)
+# A、B 两组同时运行 OpenCV，单次运算最多使用一半的 CPU 核，避免线程过多争抢 CPU
+cv2.setNumThreads(max(1, (os.cpu_count() or 2) // 2))
+
+# 平铺后的纹理, 键为 (纹理内容哈希, 宽, 高, 缩放系数), 内容哈希已包含纹理尺寸
+_tile_cache = {}
+_tile_lock = threading.Lock()
+_TILE_CACHE_SIZE = 4
+
+# 模糊深度图缓存未命中时串行处理，A、B 两组不会重复模糊、同时写同一个文件
+_blur_lock = threading.Lock()
+
+
+def wand_from_array(image_array):
+    """将 numpy 图像数组直接转为 Wand 图像，不经过 PNG 编解码"""
+    image_array = np.ascontiguousarray(image_array)
+    if image_array.ndim == 2:
+        return WandImage.from_array(image_array, channel_map="I")
+    return WandImage.from_array(image_array)
 
 
 def get_image_hash(image_array):
-    """计算图像数组的哈希值"""
-    return hashlib.md5(image_array.tobytes()).hexdigest()
+    """
+    计算图像数组的哈希值（xxh3 直接读取数组缓冲区，不复制数据）
 
+    形状和类型一并计入哈希，字节相同但尺寸不同的图像不会冲突
+    """
+    image_array = np.ascontiguousarray(image_array)
+    hasher = xxhash.xxh3_64(f"{image_array.shape}{image_array.dtype}".encode())
+    hasher.update(image_array)
+    return hasher.hexdigest()
 
-def get_cached_depth_map(image_array, cache_dir=CACHE_DIR):
-    """获取缓存的深度图,如果不存在则返回None"""
-    image_hash = get_image_hash(image_array)
+
+def _save_cache_png(image, cache_path):
+    """先写入临时文件再整体替换，其他线程不会读到写了一半的 PNG"""
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{threading.get_ident()}.tmp")
+    image.save(tmp_path, format="PNG", **CACHE_PNG_OPTIONS)
+    os.replace(tmp_path, cache_path)
+
+
+def save_depth_map(depth_map, image_hash, cache_dir=CACHE_DIR):
+    """保存深度图到缓存, image_hash 由调用方计算, 避免重复哈希"""
     cache_path = cache_dir / f"{image_hash}.png"
-    if not cache_dir.exists():
-        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    _save_cache_png(depth_map, cache_path)
+    logger.info("Saved depth map to cache: {}", cache_path)
+
 
-    if cache_path.exists():
-        logger.info(f"Using cached depth map: {cache_path}")
-        return Image.open(cache_path)
-    return None
+def blur_depth_map(depth_image, blur_radius):
+    """
+    对深度图进行高斯模糊
 
+    小半径使用 OpenCV 的 GaussianBlur, 大半径使用 FFT 做两次一维卷积（可分离高斯）
+    """
+    depth = np.asarray(depth_image)
+    if blur_radius <= FFT_BLUR_RADIUS:
+        blurred = cv2.GaussianBlur(depth, (0, 0), sigmaX=blur_radius)
+        return Image.fromarray(blurred)
+
+    half = math.ceil(3 * blur_radius)
+    x = np.arange(-half, half + 1, dtype=np.float32)
+    kernel = np.exp(-(x**2) / (2 * blur_radius**2))
+    kernel /= kernel.sum()
+
+    # 先镜像填充边缘，再按行、列分别卷积
+    padded = np.pad(depth.astype(np.float32), half, mode="reflect")
+    blurred = fftconvolve(padded, kernel[:, None], mode="valid")
+    blurred = fftconvolve(blurred, kernel[None, :], mode="valid")
+    return Image.fromarray(np.clip(blurred + 0.5, 0, 255).astype(np.uint8))
+
+
+@functools.lru_cache(maxsize=4)
+def _load_depth_map(image_hash):
+    """读取原始深度图并保留在内存中,不同模糊半径共用同一份解码结果"""
+    # 原始深度图不存在时抛出 FileNotFoundError, 异常不会被 lru_cache 缓存
+    depth_image = Image.open(CACHE_DIR / f"{image_hash}.png")
+    depth_image.load()
+    return depth_image
+
+
+@functools.lru_cache(maxsize=8)
+def _load_blurred_depth_map(image_hash, blur_radius):
+    """按 (图像哈希, 模糊半径) 读取模糊后的深度图,结果保留在内存中"""
+    cache_path = BLURRED_CACHE_DIR / f"{image_hash}_{blur_radius:.2f}.png"
+    # lru_cache 不会合并同时发生的未命中，加锁后另一组直接读取刚写好的文件
+    with _blur_lock:
+        if cache_path.exists():
+            logger.info("Using cached blurred depth map: {}", cache_path)
+            depth_image = Image.open(cache_path)
+            depth_image.load()
+            return depth_image
+
+        depth_image = _load_depth_map(image_hash)
+        if blur_radius > 0:
+            depth_image = blur_depth_map(depth_image, blur_radius)
+            _save_cache_png(depth_image, cache_path)
+        return depth_image
 
-def save_depth_map(depth_map, image_array, cache_dir=CACHE_DIR):
-    """保存深度图到缓存"""
+
+def _compute_depth(image_array):
+    """
+    确保背景图的深度图已生成，返回深度图的缓存键
+
+    依次查找内存缓存、磁盘缓存，都没有时才生成深度图；
+    A、B 两组共用同一个缓存键，深度估计和哈希都只执行一次
+    """
     image_hash = get_image_hash(image_array)
-    cache_path = cache_dir / f"{image_hash}.png"
-    depth_map.save(cache_path)
-    logger.info(f"Saved depth map to cache: {cache_path}")
+    try:
+        _load_depth_map(image_hash)
+    except FileNotFoundError:
+        depth_image = handle_depth(image_array)
+        save_depth_map(depth_image, image_hash)
+    return image_hash
+
+
+def _try_compute_depth(image_array):
+    """调用 _compute_depth，失败时记录错误并返回 None，与合成步骤的错误处理一致"""
+    try:
+        return _compute_depth(image_array)
+    except Exception as e:
+        logger.error(f"深度图生成失败: {e}")
+        logger.error("错误堆栈:\n" + traceback.format_exc())
+        return None
+
+
+def get_tiled_texture(texture_image, width, height, scale_factor):
+    """
+    获取平铺后的纹理，相同纹理、尺寸和缩放系数的结果只计算一次
+
+    缓存键使用纹理内容的完整哈希（含形状），不依赖数组对象的 id；
+    A、B 两组并行运行时，由锁保证首次平铺只执行一次；
+    返回的数组会被多次复用，调用方不能原地修改
+    """
+    key = (get_image_hash(texture_image), width, height, float(scale_factor))
+    with _tile_lock:
+        tiled = _tile_cache.get(key)
+        if tiled is None:
+            tiled = create_tiled_texture_array(
+                texture_image, width, height, scale_factor=scale_factor
+            )
+            if len(_tile_cache) >= _TILE_CACHE_SIZE:
+                _tile_cache.clear()
+            _tile_cache[key] = tiled
+    return tiled
 
 
 def process_image(input_image):
@@ -59,68 +192,22 @@ def apply_displacement(input_image, depth_image, strength):
     if input_image is None or depth_image is None:
         return None
 
-    # 创建临时文件保存输入图片和深度图
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as input_temp:
-        input_temp = Image.fromarray(input_image)
-        input_path = uuid.uuid4().hex + ".png"
-        input_temp.save(input_path)
-
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as depth_temp:
-        depth_temp = Image.fromarray(depth_image)
-        depth_path = uuid.uuid4().hex + ".png"
-        depth_temp.save(depth_path)
-
-    try:
-        # 应用位移变换
-        result = displacement_mapping(input_path, depth_path, strength)
-
-        # 创临时文件保存结果
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as output_temp:
-            output_path = output_temp.name
-            result.save(filename=output_path)
-            return output_path
-
-    finally:
-        # 清理临时文件
-        for path in [input_path, depth_path]:
-            try:
-                os.unlink(path)
-            except:
-                pass
+    # 直接在数组上进行置换，结果以数组形式交给 Gradio
+    return displacement_mapping_cv(input_image, depth_image, strength)
 
 
 def apply_composite(texture_image, background_image, mask_image, tile_texture):
     if texture_image is None or background_image is None or mask_image is None:
         return None
 
-    # 保存临时文件
-    texture_path = uuid.uuid4().hex + ".png"
-    background_path = uuid.uuid4().hex + ".png"
-    mask_path = uuid.uuid4().hex + ".png"
-
-    try:
-        # 保存输入图片
-        Image.fromarray(texture_image).save(texture_path)
-        Image.fromarray(background_image).save(background_path)
-        Image.fromarray(mask_image).save(mask_path)
-
+    with (
+        wand_from_array(texture_image) as texture,
+        wand_from_array(background_image) as background,
+        wand_from_array(mask_image) as mask,
+    ):
         # 进行合成
-        result = composite_images(
-            texture_path, background_path, mask_path, tile=tile_texture
-        )
-
-        # 保存结果
-        output_path = uuid.uuid4().hex + ".png"
-        result.save(filename=output_path)
-        return output_path
-
-    finally:
-        # 清理临时文件
-        for path in [texture_path, background_path, mask_path]:
-            try:
-                os.unlink(path)
-            except:
-                pass
+        with composite_images(texture, background, mask, tile=tile_texture) as result:
+            return np.array(result)
 
 
 def apply_combined_effects(
@@ -159,110 +246,96 @@ def apply_combined_effects(
     if texture_image is None or background_image is None or mask_image is None:
         return None
 
-    output_dir = Path("output")
-    output_dir.mkdir(parents=True, exist_ok=True)
-    output_dir = output_dir.as_posix()
+    depth_key = _try_compute_depth(background_image)
+    if depth_key is None:
+        return None
+
+    return _apply_effects(
+        texture_image,
+        background_image,
+        mask_image,
+        depth_key,
+        texture_scale,
+        tile_texture,
+        displacement_strength,
+        blur_radius,
+        lighting_strength,
+        black_point,
+        white_point,
+        gamma,
+        contrast,
+        lightness,
+        detail_strength,
+    )
+
 
-    # 初始化临时文件路径变量
-    texture_path = None
-    background_path = None
-    mask_path = None
-    depth_path = None
-    displaced_path = None
-    tiled_path = None
+def _apply_effects(
+    texture_image,
+    background_image,
+    mask_image,
+    depth_key,
+    texture_scale,
+    tile_texture,
+    displacement_strength,
+    blur_radius,
+    lighting_strength=0.5,
+    black_point=0,
+    white_point=100,
+    gamma=1.0,
+    contrast=1.0,
+    lightness=0,
+    detail_strength=0.5,
+):
+    """
+    在已生成的深度图上应用组合效果
 
+    depth_key 为 _compute_depth 返回的缓存键，模糊半径因参数组而异，在这里处理
+    """
+    depth_image = None
     try:
-        # 保存临时文件
-        texture_path = uuid.uuid4().hex + ".png"
-        background_path = uuid.uuid4().hex + ".png"
-        mask_path = uuid.uuid4().hex + ".png"
-        depth_path = uuid.uuid4().hex + ".png"
-
-        # 保存输入图片
-        Image.fromarray(texture_image).save(texture_path)
-        Image.fromarray(background_image).save(background_path)
-        Image.fromarray(mask_image).save(mask_path)
-
-        # 1. 检查缓存的深度图
-        depth_image = get_cached_depth_map(background_image)
-        if depth_image is None:
-            # 如果没有缓存,则生成新的深度图
-            depth_image = handle_depth(background_image)
-            save_depth_map(depth_image, background_image)
+        # 1. 获取模糊后的深度图（优先使用缓存）
+        depth_image = _load_blurred_depth_map(depth_key, float(blur_radius))
 
-        if blur_radius > 0:
-            depth_image = depth_image.filter(
-                ImageFilter.GaussianBlur(radius=blur_radius)
-            )
-        depth_image.save(depth_path)
+        depth_array = np.asarray(depth_image)
+        # 背景灰度图只计算一次，光照图和细节提取共用
+        background_gray = cv2.cvtColor(background_image, cv2.COLOR_RGB2GRAY)
 
         # 2. 对纹理进行深度置换
-        displaced_texture = None
-        with WandImage(filename=texture_path) as texture:
-            if tile_texture:
-                # 先进行平铺
-                with WandImage(filename=background_path) as background:
-                    texture = create_tiled_texture(
-                        texture,
-                        background.width,
-                        background.height,
-                        scale_factor=texture_scale,
-                    )
-                    # 保存平铺后的纹理
-                    tiled_path = uuid.uuid4().hex + ".png"
-                    texture.save(filename=tiled_path)
-
-                # 对平铺后的纹理进行深度置换
-                displaced_texture = displacement_mapping(
-                    tiled_path, depth_path, displacement_strength
-                )
-            else:
-                # 直接对原纹理进行深度置换
-                displaced_texture = displacement_mapping(
-                    texture_path, depth_path, displacement_strength
-                )
+        texture = texture_image
+        if tile_texture:
+            # 先进行平铺，再对平铺后的纹理进行深度置换
+            height, width = background_image.shape[:2]
+            texture = get_tiled_texture(texture_image, width, height, texture_scale)
+        displaced_texture = displacement_mapping_cv(
+            texture, depth_array, displacement_strength
+        )
 
-        # 确保 displaced_texture 被创建
-        if displaced_texture is None:
-            return None
-
-        # 保存位移后纹理
-        displaced_path = output_dir + "/debug_displaced_" + uuid.uuid4().hex + ".png"
-        displaced_texture.save(filename=displaced_path)
-
-        # 在合成之前生成光照图
-        with WandImage(filename=depth_path) as depth:
-            with WandImage(filename=background_path) as background:
-                with WandImage(filename=mask_path) as mask:
-                    # 生成光照图
-                    lighting_map = generate_lighting_map(
-                        depth,
-                        background,
-                        mask,
-                    )
+        # 在合成之前生成光照图，光照强度为 0 时光照层不起作用，直接跳过
+        # 遮罩在合成时统一应用，A、B 两组共用同一份遮罩 alpha
+        lighting_map = None
+        if lighting_strength > 0:
+            lighting_map = generate_lighting_map(
+                depth_array, background_image, background_gray=background_gray
+            )
 
         # 应用光照和合成
-        with WandImage(filename=displaced_path) as texture:
-            with WandImage(filename=background_path) as background:
-                with WandImage(filename=mask_path) as mask:
-                    final_result = composite_with_lighting(
-                        texture,
-                        background,
-                        mask,
-                        lighting_map,
-                        lighting_strength=lighting_strength,
-                        black_point=black_point,
-                        white_point=white_point,
-                        gamma=gamma,
-                        contrast=contrast,
-                        lightness=lightness,
-                        detail_strength=detail_strength,
-                    )
+        final_result = composite_with_lighting(
+            displaced_texture,
+            background_image,
+            mask_image,
+            lighting_map,
+            lighting_strength=lighting_strength,
+            black_point=black_point,
+            white_point=white_point,
+            gamma=gamma,
+            contrast=contrast,
+            lightness=lightness,
+            detail_strength=detail_strength,
+            background_gray=background_gray,
+        )
 
-        # 保存最终结果
-        output_path = output_dir + "/debug_final_" + uuid.uuid4().hex + ".png"
-        final_result.save(filename=output_path)
-        return output_path
+        # 合成结果本身就是数组，直接交给 Gradio
+        return final_result
 
     except Exception as e:
         logger.error(f"组合效果处理失败: {e}")
@@ -271,8 +344,8 @@ def apply_combined_effects(
         logger.error("错误堆栈:\n" + traceback.format_exc())
 
         # 检查关键步骤是否成功
-        if "depth_image" not in locals():
-            logger.error("深度图生成失败")
+        if depth_image is None:
+            logger.error("模糊深度图读取失败")
         elif "displaced_texture" not in locals():
             logger.error("深度置换失败")
         elif "final_result" not in locals():
@@ -280,31 +353,6 @@ def apply_combined_effects(
 
         return None
 
-    finally:
-        # 清理所有临时文件
-        temp_files = [
-            path
-            for path in [
-                texture_path,
-                background_path,
-                mask_path,
-                depth_path,
-                tiled_path,
-            ]
-            if path is not None
-        ]
-        for path in temp_files:
-            try:
-                os.unlink(path)
-            except:
-                pass
-        # 如果 displaced_path 存在，最后清理它
-        if displaced_path:
-            try:
-                os.unlink(displaced_path)
-            except:
-                pass
-
 
 # 创建Gradio界面
 with gr.Blocks() as demo:
@@ -458,13 +506,6 @@ with gr.Blocks() as demo:
             # 生成结果按钮
             generate_both = gr.Button("生成对比结果", variant="primary")
 
-        # 定义参数复制函数
-        def copy_params_a_to_b(*params_a):
-            return params_a
-
-        def copy_params_b_to_a(*params_b):
-            return params_b
-
         # 定义生成对比结果函数
         def generate_comparison(
             texture,
@@ -493,16 +534,34 @@ with gr.Blocks() as demo:
             lightness_b,
             detail_strength_b,
         ):
-            # 如果使用纯色，创建纯色图像作为纹理
-            if use_solid_color:
-                with WandImage(width=100, height=100, background=solid_color) as solid:
-                    texture = np.array(solid)
+            if background is not None and use_solid_color:
+                # 纯色纹理直接按背景尺寸广播，不需要平铺；置换后也不会变化
+                color = Color(solid_color)
+                texture = np.broadcast_to(
+                    np.array(
+                        [color.red_int8, color.green_int8, color.blue_int8],
+                        dtype=np.uint8,
+                    ),
+                    (*background.shape[:2], 3),
+                )
+                tile_texture = False
+                strength_a = strength_b = 0
+
+            if texture is None or background is None or mask is None:
+                return None, None
+
+            # 深度图只计算一次，A、B 两组参数共用
+            depth_key = _try_compute_depth(background)
+            if depth_key is None:
+                return None, None
 
-            # 生成A结果
-            result_a = apply_combined_effects(
+            # A、B 两组结果在常驻线程池中并行生成，OpenCV 与 Numba 运行时会释放 GIL
+            future_a = _pool.submit(
+                _apply_effects,
                 texture,
                 background,
                 mask,
+                depth_key,
                 texture_scale,
                 tile_texture,
                 strength_a,
@@ -515,12 +574,12 @@ with gr.Blocks() as demo:
                 lightness_a,
                 detail_strength_a,
             )
-
-            # 生成B结果
-            result_b = apply_combined_effects(
+            future_b = _pool.submit(
+                _apply_effects,
                 texture,
                 background,
                 mask,
+                depth_key,
                 texture_scale,
                 tile_texture,
                 strength_b,
@@ -533,12 +592,11 @@ with gr.Blocks() as demo:
                 lightness_b,
                 detail_strength_b,
             )
+            return future_a.result(), future_b.result()
 
-            return result_a, result_b
-
-        # 设置按钮点击事件
+        # 设置按钮点击事件，参数复制直接在浏览器端完成，不经过服务端
         copy_a_to_b.click(
-            fn=copy_params_a_to_b,
+            fn=None,
             inputs=[
                 strength_a,
                 blur_radius_a,
@@ -561,10 +619,11 @@ with gr.Blocks() as demo:
                 lightness_b,
                 detail_strength_b,
             ],
+            js="(...args) => args",
         )
 
         copy_b_to_a.click(
-            fn=copy_params_b_to_a,
+            fn=None,
             inputs=[
                 strength_b,
                 blur_radius_b,
@@ -587,6 +646,7 @@ with gr.Blocks() as demo:
                 lightness_a,
                 detail_strength_a,
             ],
+            js="(...args) => args",
         )
 
         generate_both.click(